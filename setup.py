@@ -18,7 +18,7 @@ setup(
     long_description_content_type="text/markdown",
 
     packages=['sqljob'],
-    install_requires=['pandas', 'sqlalchemy'],
+    install_requires=['pandas', 'sqlalchemy>=1.4', 'pyarrow>=14'],
     test_require=[],
     package_data={},
     entry_points={},
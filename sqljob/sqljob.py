@@ -3,18 +3,36 @@
 from logging import getLogger
 from datetime import datetime
 from contextlib import contextmanager
-import csv
 import os
 import io
+import functools
+import json
+import pickle
+import importlib
+import types
+import atexit
+import weakref
+import queue
 import threading
 import multiprocessing
+import concurrent.futures
 import warnings
 
 import pandas as pd
 import sqlalchemy
+from sqlalchemy.pool import NullPool
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 
 logger = getLogger(__name__)
 
+# compression codecs for CSV files by file extension
+_CSV_COMPRESSIONS = {".gz": "gzip", ".bz2": "bz2", ".zst": "zstd", ".lz4": "lz4"}
+# copy-on-write is always enabled since pandas 3.0, and optional before
+_ALWAYS_COPY_ON_WRITE = int(pd.__version__.split(".")[0]) >= 3
+
+
 
 
 class Connector:
@@ -30,6 +48,18 @@ class Connector:
         self.args = args
         self.kwargs = kwargs
 
+    def __getstate__(self):
+        # modules cannot be pickled, so the module is passed to child processes by name
+        state = self.__dict__.copy()
+        if isinstance(self.connect_module, types.ModuleType):
+            state["connect_module"] = self.connect_module.__name__
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state["connect_module"], str):
+            state["connect_module"] = importlib.import_module(state["connect_module"])
+        self.__dict__.update(state)
+
     @contextmanager
     def connect(self):
         conn = self.connect_module.connect(*self.args, **self.kwargs)
@@ -50,9 +80,23 @@ class SqlJob:
       params: tuple, parameters passed along the query
       manyparams: bool, indicates that the query should be executed with `executemany`
       postcommit: bool, if set, run commit method (if available) after the query execution
-      backend: "threading" or "multiprocessing", indicates the backend module for running a child task
-      csvfile: str or None, if given, query result is written to this file
+      backend: "threading" or "multiprocessing", indicates the backend module for running a child task.
+               multiprocessing jobs run on a process pool shared by all jobs, whose size is set by
+               the environment variable SQLJOB_WORKERS (default 4). The pool requires the connector and
+               params to be picklable (e.g. a `Connector` or sqlalchemy url string, not an engine);
+               otherwise the job runs on its own process, which works only with the fork start method
+      csvfile: str or None, if given, query result is written to this file.
+               compressed if the file name ends with ".gz", ".bz2", ".zst" or ".lz4"
+      parquetfile: str or None, if given, query result is written to this file in parquet format
+      arrowfile: str or None, if given, the first `max_df_rows` rows of the query result are written to this file
+                 in arrow IPC format, from which the result data frame is loaded
       max_df_rows: int, maximum number of rows to keep in the result data frame
+      dtype_backend: None or "pyarrow", if "pyarrow", the result data frame keeps the arrow column types
+                     (pd.ArrowDtype) instead of converting them to numpy types
+      fetchsize: int, number of rows to fetch from the database at once
+      server_side_cursor: bool, if set, keep the result set on the database server and stream it by fetchsize rows.
+                          supported for sqlalchemy, psycopg2, psycopg, MySQLdb and pymysql connections.
+                          Postgres allows only SELECT and VALUES statements with this option
       logquery: bool, if set, query statement is added to the log message
       logquery_params: bool, if set, query parameters are added to the log message
     """
@@ -60,8 +104,8 @@ class SqlJob:
     result_dir = os.path.abspath("./sqljob-results")
 
     def __init__(self, query, connector, params=(), manyparams=False, postcommit=True,
-                 backend="threading", csvfile=None, picklefile=None, max_df_rows=10000,
-                 logquery=True, logquery_params=False):
+                 backend="threading", csvfile=None, parquetfile=None, arrowfile=None, max_df_rows=10000, dtype_backend=None,
+                 fetchsize=10000, server_side_cursor=False, logquery=True, logquery_params=False):
 
         self.connector = connector
         self.query = query
@@ -71,6 +115,10 @@ class SqlJob:
         self.backend = backend
         assert backend in ("threading", "multiprocessing"), "Invalid backend: '{}'".format(backend)
         self.max_df_rows = max_df_rows
+        self.dtype_backend = dtype_backend
+        assert dtype_backend in (None, "pyarrow"), "Invalid dtype_backend: '{}'".format(dtype_backend)
+        self.fetchsize = fetchsize
+        self.server_side_cursor = server_side_cursor
         self.logquery = logquery
         self.logquery_params = logquery_params
 
@@ -80,126 +128,303 @@ class SqlJob:
         thistime = datetime.now().strftime("%y%m%d_%H%M%S")
         if csvfile is None:
             csvfile = "job_{}_{}.csv".format(self.jobid, thistime)
-        if picklefile is None:
-            picklefile = "job_{}_{}.pkl".format(self.jobid, thistime)
+        if parquetfile is None:
+            parquetfile = "job_{}_{}.parquet".format(self.jobid, thistime)
+        if arrowfile is None:
+            arrowfile = "job_{}_{}.arrow".format(self.jobid, thistime)
         self.csvfile = os.path.join(SqlJob.result_dir, csvfile)
-        self.picklefile = os.path.join(SqlJob.result_dir, picklefile)
+        self.parquetfile = os.path.join(SqlJob.result_dir, parquetfile)
+        self.arrowfile = os.path.join(SqlJob.result_dir, arrowfile)
+        self._legacy_picklefile = os.path.splitext(self.parquetfile)[0] + ".pkl"
+        for d in {os.path.dirname(f) for f in (self.csvfile, self.parquetfile, self.arrowfile)}:
+            os.makedirs(d, exist_ok=True)
 
-        self.worker = None  # placeholder to store the worker object (Thread or Process)
+        self.worker = None  # placeholder to store the worker object (Thread, Process or Future)
+        self._error = None  # placeholder to keep the exception raised by the threading job
         self._result_df = None  # placeholder to keep the query outcome
     
 
     def _make_worker(self):
         args = (self.connector, self.query)
         kwargs = {"params": self.params, "manyparams": self.manyparams, "postcommit": self.postcommit,
-                  "csvfile": self.csvfile, "picklefile": self.picklefile, "max_df_rows": self.max_df_rows,
+                  "csvfile": self.csvfile, "parquetfile": self.parquetfile,
+                  "arrowfile": self.arrowfile, "max_df_rows": self.max_df_rows, "fetchsize": self.fetchsize,
+                  "server_side_cursor": self.server_side_cursor,
                   "logquery": self.logquery, "logquery_params": self.logquery_params}
         #logger.debug("%s", args)
         #logger.debug("%s", kwargs)
         if self.backend=="threading":
-            self.worker = threading.Thread(target=_sql_task, args=args, kwargs=kwargs, name="sqljob_{}".format(self.jobid))
+            self.worker = threading.Thread(target=self._run_task, args=args, kwargs=kwargs, name="sqljob_{}".format(self.jobid))
         elif self.backend=="multiprocessing":
             warnings.warn("multiprocessing backend is experimental")
-            self.worker = multiprocessing.Process(target=_sql_task, args=args, kwargs=kwargs, name="sqljob_{}".format(self.jobid))
+            try:
+                # the process pool sends the arguments to the workers by pickle
+                pickle.dumps((args, kwargs))
+            except Exception as e:
+                logger.warning("Job arguments cannot be pickled (%s), the job runs on its own process", e)
+                self.worker = multiprocessing.Process(target=_sql_task, args=args, kwargs=kwargs,
+                                                      name="sqljob_{}".format(self.jobid))
+            else:
+                # submitting to the pool starts the job
+                self.worker = _get_process_pool().submit(_sql_task, *args, **kwargs)
+                self.worker.add_done_callback(functools.partial(_log_failure, self.jobid))
             
+    def _run_task(self, *args, **kwargs):
+        try:
+            _sql_task(*args, **kwargs)
+        except Exception as e:
+            self._error = e
+            raise
+
     def start(self):
-        self._make_worker()
-        
         logger.info("Start SQL worker (id=%s)", self.jobid)
-        self.worker.start()
+        self._make_worker()
+        if not isinstance(self.worker, concurrent.futures.Future):
+            self.worker.start()
         return self
     
     def wait(self, timeout=None):
-        self.worker.join(timeout)
+        if isinstance(self.worker, concurrent.futures.Future):
+            concurrent.futures.wait([self.worker], timeout=timeout)
+        else:
+            self.worker.join(timeout)
         return self
     
     def running(self):
-        return self.worker.is_alive()
+        if isinstance(self.worker, concurrent.futures.Future):
+            return not self.worker.done()
+        else:
+            return self.worker.is_alive()
+
+    def failed(self):
+        """
+        Returns True if the job has finished with an error
+        """
+        if self.worker is None or self.running():
+            return False
+        elif isinstance(self.worker, concurrent.futures.Future):
+            return self.worker.cancelled() or self.worker.exception() is not None
+        elif isinstance(self.worker, multiprocessing.Process):
+            return self.worker.exitcode != 0
+        else:
+            return self._error is not None
 
     @property
     def result_df(self):
+        """
+        Returns the result data frame, loaded from the result files on the first access
+
+        With pandas copy-on-write (default since pandas 3.0), the data frame shares the data with the cached one
+        until it is modified. Otherwise it is a deep copy of the cache.
+        """
         if self.running():
             print("Job is still running")
             return None
+        elif self.failed():
+            print("Job failed, no data frame result")
+            return None
         elif self._result_df is not None:
-            return self._result_df.copy()
+            return _copy_df(self._result_df)
         else:
-            if os.path.isfile(self.picklefile):
-                df = pd.read_pickle(self.picklefile)
-                self._result_df = df
-                return df.copy()
+            if os.path.isfile(self.arrowfile):
+                df = _read_arrow(self.arrowfile, self.dtype_backend)
+            elif os.path.isfile(self.parquetfile):
+                df = _read_parquet_head(self.parquetfile, self.max_df_rows, self.dtype_backend)
+            elif os.path.isfile(self._legacy_picklefile):
+                # result written by older versions
+                df = pd.read_pickle(self._legacy_picklefile)
             else:
                 print("No data frame result for this job")
                 return None
+            self._result_df = df
+            return _copy_df(df)
 
 def sqljob(query, connector, params=(), manyparams=False, postcommit=False, backend="threading", 
-           csvfile=None, picklefile=None, max_df_rows=10000, logquery=True, logquery_params=False):
+           csvfile=None, parquetfile=None, arrowfile=None, max_df_rows=10000, dtype_backend=None, fetchsize=10000,
+           server_side_cursor=False, logquery=True, logquery_params=False):
     job = SqlJob(query, connector, params=params, manyparams=manyparams, postcommit=postcommit,
-                 backend=backend, csvfile=csvfile, picklefile=picklefile, max_df_rows=max_df_rows,
+                 backend=backend, csvfile=csvfile, parquetfile=parquetfile, arrowfile=arrowfile,
+                 max_df_rows=max_df_rows,
+                 dtype_backend=dtype_backend, fetchsize=fetchsize, server_side_cursor=server_side_cursor,
                  logquery=logquery, logquery_params=logquery_params)
     job.start()
     return job
 
 
+def _copy_df(df):
+    """
+    Returns a copy of the data frame that can be modified without affecting the original
+    """
+    if _ALWAYS_COPY_ON_WRITE or pd.options.mode.copy_on_write is True:
+        # columns are copied when modified
+        return df.copy(deep=False)
+    return df.copy()
+
+
+_process_pool = None  # process pool for the multiprocessing backend, created on first use
+_process_pool_lock = threading.Lock()
+
+
+def _get_process_pool():
+    """
+    Returns the process pool shared by the jobs with multiprocessing backend
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            max_workers = int(os.environ.get("SQLJOB_WORKERS", "4"))
+            logger.debug("Creating process pool with %d workers", max_workers)
+            _process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    return _process_pool
+
+
+def _log_failure(jobid, future):
+    """
+    Log the exception raised by the job running on the process pool
+    """
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("SQL job (id=%s) failed", jobid, exc_info=future.exception())
+
+
+_engines = weakref.WeakSet()  # engines created by `_get_engine`
+
+
+@functools.lru_cache(maxsize=32)
+def _get_engine(url):
+    """
+    Returns sqlalchemy engine for the url, cached so that jobs share the connection pool
+    """
+    logger.debug("Creating sqlalchemy engine")
+    kwargs = {"pool_pre_ping": True}
+    if multiprocessing.parent_process() is not None:
+        # child processes do not keep connections after the job
+        kwargs["poolclass"] = NullPool
+    engine = sqlalchemy.create_engine(url, **kwargs)
+    _engines.add(engine)
+    return engine
+
+
+def _dispose_engines(close=True):
+    """
+    Dispose connection pools of the engines created by `_get_engine`
+
+    With `close=False`, pooled connections are discarded without being closed,
+    which is the way to drop connections inherited from the parent after fork.
+    """
+    for engine in list(_engines):
+        engine.dispose(close=close)
+
+
+atexit.register(_dispose_engines)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=functools.partial(_dispose_engines, close=False))
+
+
 def _sql_task(connector, query, params=(), manyparams=False, postcommit=True,
-              csvfile=None, picklefile=None, max_df_rows=10000, logquery=True, logquery_params=False):
+              csvfile=None, parquetfile=None, arrowfile=None, max_df_rows=10000, fetchsize=10000, server_side_cursor=False,
+              logquery=True, logquery_params=False):
     # defines a generic sql task
     logger.info("Start SQL job")
-    logger.debug("Result files are: csv '%s' and pickle '%s'", csvfile, picklefile)
-    os.makedirs(os.path.abspath(os.path.dirname(csvfile)), exist_ok=True)
-    os.makedirs(os.path.abspath(os.path.dirname(picklefile)), exist_ok=True)
+    logger.debug("Result files are: csv '%s', parquet '%s' and arrow '%s'", csvfile, parquetfile, arrowfile)
 
     logger.debug("Establishing connection to the database")
     if isinstance(connector, str):
-        engine = sqlalchemy.create_engine(connector)
+        engine = _get_engine(connector)
     else:
         engine = connector
     assert hasattr(engine, "connect") and callable(engine.connect), "Connector ({}) does not have connect method".format(type(engine))
     with engine.connect() as conn:
-        try:
-            c = conn.cursor()
-        except Exception as e:
+        if isinstance(conn, sqlalchemy.engine.Connection):
+            # sqlalchemy connection executes the query directly
+            c = conn
+            if server_side_cursor:
+                c = c.execution_options(stream_results=True, max_row_buffer=fetchsize)
+        elif hasattr(conn, "cursor"):
+            c = _server_side_cursor(conn) if server_side_cursor else conn.cursor()
+        else:
             logger.debug("`cursor` method is not available, will execute query on the connection directly")
             c = conn
+        if hasattr(c, "arraysize"):
+            # let the driver transfer `fetchsize` rows per round trip
+            c.arraysize = fetchsize
         logger.info("Start running query%s%s",
                     "\n" + query if logquery else "",
                     "\n with" + str(params) if logquery_params else "")
 
         t1 = datetime.now()
-        if manyparams:
+        if isinstance(c, sqlalchemy.engine.Connection):
+            # `exec_driver_sql` keeps the paramstyle of the driver, and runs `executemany` for a list of params
+            result = c.exec_driver_sql(query, list(params) if manyparams else (params or None))
+        elif manyparams:
             result = c.executemany(query, params)
         else:
             result = c.execute(query, params)
-        if postcommit:
-            logger.debug("Postcommit mode on")
-            if hasattr(conn, "commit"):
-                conn.commit()
-                logger.debug("Changes commited")
-            else:
-                logger.debug("The connection (%s) has no commit method", type(conn))
+        if result is None:
+            # the return value of `execute` is undefined in DB-API (e.g. None in psycopg2)
+            result = c
+        if postcommit and not server_side_cursor:
+            _commit(conn)
         t2 = datetime.now()
         logger.info("Finish running query (Elapsed: %s)", t2-t1)
         logger.info("%s rows has been affected", getattr(result, "rowcount", "???"))
         
         logger.info("Fetch and write result table if any")
-        _fetch_and_write(result, csvfile, picklefile, max_df_rows)
+        _fetch_and_write(result, csvfile, parquetfile, arrowfile, max_df_rows, fetchsize)
+        if postcommit and server_side_cursor:
+            # commit closes server-side cursors, so it waits until the result is fetched
+            _commit(conn)
     logger.info("End SQL job")
 
 
+def _server_side_cursor(conn):
+    """
+    Returns a cursor that keeps the result set on the server, for drivers known to support it
+    """
+    driver = type(conn).__module__.split(".")[0]
+    if driver in ("psycopg2", "psycopg"):
+        logger.debug("Using named cursor of %s", driver)
+        return conn.cursor(name="sqljob_{}_{}".format(os.getpid(), id(conn)))
+    if driver in ("MySQLdb", "pymysql"):
+        logger.debug("Using SSCursor of %s", driver)
+        return conn.cursor(importlib.import_module(driver + ".cursors").SSCursor)
+    logger.debug("Server-side cursor is not known for the connection (%s)", type(conn))
+    return conn.cursor()
+
+
+def _commit(conn):
+    logger.debug("Postcommit mode on")
+    if hasattr(conn, "commit"):
+        conn.commit()
+        logger.debug("Changes commited")
+    else:
+        logger.debug("The connection (%s) has no commit method", type(conn))
+
+
 def _get_header(cursor):
     """
     Returns column names from the query result object (cursor, result proxy etc.)
     """
-    if hasattr(cursor, "description"):
+    if isinstance(cursor, sqlalchemy.engine.Result):
+        # sqlalchemy results give the column names by `keys`, if they return rows at all
+        if not getattr(cursor, "returns_rows", True):
+            logger.debug("No header is found because the sqlalchemy result does not return rows")
+            return None
+        header = list(cursor.keys())
+        logger.debug("Header is retrieved by the `keys` method of sqlalchemy result")
+        return header
+    # attributes are looked up once, as they may be computed properties in some drivers
+    description = getattr(cursor, "description", None)
+    if description is not None:
         try:
-            header = [d[0] for d in cursor.description]
+            header = [d[0] for d in description]
             logger.debug("Header is retrieved from the first elements of description field")
             return header
         except Exception as e:
             logger.debug("Failed to fetch the header from description field: '%s'", e)
-    if hasattr(cursor, "keys"):
+    keys = getattr(cursor, "keys", None)
+    if keys is not None:
         try:
-            header = list(cursor.keys())
+            header = list(keys())
             logger.debug("Header is retrieved by the `keys` method")
             return header
         except Exception as e:
@@ -208,84 +433,379 @@ def _get_header(cursor):
     return None
 
 
-def _fetch_and_write(cursor, csvfile=None, picklefile=None, max_df_rows=10000):
+def _to_string(value):
+    """
+    Format a value as a string, lists and dicts (e.g. array and json columns) as json
+    """
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def _to_string_array(values):
+    return pa.array([None if v is None else _to_string(v) for v in values], type=pa.string())
+
+
+def _to_arrow_table(rows, names):
+    """
+    Convert a list of rows (or an arrow record batch) into an arrow table
+
+    Column types are inferred from the rows; columns that arrow cannot type
+    (mixed types, too large integers etc.) are stored as strings.
+    """
+    if isinstance(rows, pa.RecordBatch):
+        return pa.Table.from_batches([rows]).rename_columns(names)
+    columns = list(zip(*rows)) if len(rows) > 0 else [()] * len(names)
+    arrays = []
+    for name, col in zip(names, columns):
+        try:
+            arr = pa.array(col)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, OverflowError) as e:
+            logger.debug("Column '%s' is converted to string: '%s'", name, e)
+            arr = _to_string_array(col)
+        arrays.append(arr)
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def _cast_array(arr, typ):
+    """
+    Convert the array to the type; values are formatted by python where arrow cannot cast them to string
+    """
+    if arr.type.equals(typ):
+        return arr
+    try:
+        return arr.cast(typ, safe=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        if pa.types.is_string(typ):
+            return _to_string_array(arr.to_pylist())
+        if pa.types.is_integer(arr.type) and pa.types.is_floating(typ):
+            # integers beyond 2**53 lose precision as floats, as they do in pandas
+            return arr.cast(typ, safe=False)
+        raise
+
+
+def _cast_table(table, schema):
+    if table.schema.equals(schema):
+        return table
+    return pa.Table.from_arrays([_cast_array(col, field.type) for col, field in zip(table.columns, schema)],
+                                schema=schema)
+
+
+def _promote_type(a, b):
+    """
+    Returns a type that the values of both types fit in (e.g. float for int and float), string if there is none
+    """
+    if a.equals(b):
+        return a
+    try:
+        typ = pa.unify_schemas([pa.schema([("x", a)]), pa.schema([("x", b)])], promote_options="permissive").field(0).type
+        # make sure that arrow can cast both types into the promoted one
+        pa.array([], type=a).cast(typ)
+        pa.array([], type=b).cast(typ)
+        return typ
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return pa.string()
+
+
+def _csv_type(typ):
+    """
+    Returns the type to write to CSV; lists, structs and extension types (e.g. uuid) are written as strings
+    """
+    if pa.types.is_nested(typ) or isinstance(typ, pa.BaseExtensionType):
+        return pa.string()
+    return typ
+
+
+def _partfile(file):
+    """
+    Returns the temporary file name to write to until all rows are written
+    """
+    return file + ".part"
+
+
+class _ResultWriter:
+    """
+    Write arrow tables to csvfile, parquetfile and arrowfile (the first `max_df_rows` rows), any of which may be None
+
+    The column types are given by the first table. When a later table does not fit in them,
+    the types are promoted (e.g. int to float, or to string), and the parquet and arrow files
+    written so far are converted to the new types.
+
+    Rows are written to temporary files, which are renamed to the result files by `commit`
+    or deleted by `discard`, so that no partial result is left when the job fails.
+    """
+    def __init__(self, names, write_header, csvfile=None, parquetfile=None, arrowfile=None,
+                 max_df_rows=10000, fetchsize=10000):
+        self.names = names
+        self.write_header = write_header
+        self.csvfile = csvfile
+        self.parquetfile = parquetfile
+        self.arrowfile = arrowfile
+        self.max_df_rows = max_df_rows
+        self.fetchsize = fetchsize
+
+        self.schema = None  # column types, set by the first table
+        self.csv_sinks = []
+        self.csv_schema = None
+        self.csv_writer = None
+        self.parquet_writer = None
+        self.arrow_writer = None
+        self.df_rows = max_df_rows  # number of rows to be written to arrowfile
+
+    def write(self, table):
+        if self.schema is None:
+            self._open(table.schema)
+        elif not table.schema.equals(self.schema):
+            schema = pa.schema([pa.field(f.name, _promote_type(f.type, g.type))
+                                for f, g in zip(self.schema, table.schema)])
+            if not schema.equals(self.schema):
+                logger.info("Column types are promoted to fit in new rows: %s", schema)
+                self._promote(schema)
+            table = _cast_table(table, self.schema)
+
+        if self.csv_writer is not None:
+            self.csv_writer.write_table(_cast_table(table, self.csv_schema))
+        if self.parquet_writer is not None:
+            self.parquet_writer.write_table(table)
+        if self.arrow_writer is not None and self.df_rows > 0:
+            self.arrow_writer.write_table(table.slice(0, self.df_rows))
+            if table.num_rows > self.df_rows:
+                logger.info("Data frame is truncated to %d rows", self.max_df_rows)
+            self.df_rows -= table.num_rows
+
+    def close(self):
+        if self.csv_writer is not None:
+            self.csv_writer.close()
+            for sink in reversed(self.csv_sinks):
+                sink.close()
+            self.csv_writer = None
+            logger.info("Finish writing to CSV file '%s'", self.csvfile)
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+            logger.info("Finish writing to parquet file '%s'", self.parquetfile)
+        if self.arrow_writer is not None:
+            self.arrow_writer.close()
+            self.arrow_writer = None
+            logger.info("Data frame is written to '%s'", self.arrowfile)
+
+    def commit(self):
+        for file in (self.csvfile, self.parquetfile, self.arrowfile):
+            if file is not None and os.path.isfile(_partfile(file)):
+                os.replace(_partfile(file), file)
+
+    def discard(self):
+        for file in (self.csvfile, self.parquetfile, self.arrowfile):
+            if file is not None:
+                for f in (_partfile(file), _partfile(file) + ".old"):
+                    try:
+                        os.unlink(f)
+                    except FileNotFoundError:
+                        pass
+                logger.info("Result file '%s' is not written due to the error", file)
+
+    def _open(self, schema):
+        self.schema = schema
+        logger.debug("Schema: %s", schema)
+        if self.csvfile is not None:
+            logger.debug("Start writing rows to CSV file '%s'", self.csvfile)
+            self.csv_sinks.append(pa.OSFile(_partfile(self.csvfile), "wb"))
+            compression = _CSV_COMPRESSIONS.get(os.path.splitext(self.csvfile)[1].lower())
+            if compression is not None:
+                logger.debug("CSV file is compressed by %s", compression)
+                self.csv_sinks.append(pa.CompressedOutputStream(self.csv_sinks[-1], compression))
+            self._open_csv(self.write_header)
+        if self.parquetfile is not None:
+            logger.debug("Start writing rows to parquet file '%s'", self.parquetfile)
+            self.parquet_writer = pq.ParquetWriter(_partfile(self.parquetfile), schema, compression="snappy")
+        if self.arrowfile is not None:
+            self.arrow_writer = pa.ipc.new_file(_partfile(self.arrowfile), schema)
+
+    def _open_csv(self, include_header):
+        self.csv_schema = pa.schema([pa.field(f.name, _csv_type(f.type)) for f in self.schema])
+        # format each batch in one pass instead of in chunks of 1024 rows
+        options = pacsv.WriteOptions(include_header=include_header, batch_size=self.fetchsize)
+        self.csv_writer = pacsv.CSVWriter(self.csv_sinks[-1], self.csv_schema, write_options=options)
+
+    def _promote(self, schema):
+        self.schema = schema
+        if self.csv_writer is not None:
+            # rows written so far are kept as they are, since CSV has no column types
+            self.csv_writer.close()
+            self._open_csv(include_header=False)
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            oldfile = _partfile(self.parquetfile) + ".old"
+            os.replace(_partfile(self.parquetfile), oldfile)
+            self.parquet_writer = pq.ParquetWriter(_partfile(self.parquetfile), schema, compression="snappy")
+            with pq.ParquetFile(oldfile) as f:
+                for batch in f.iter_batches():
+                    self.parquet_writer.write_table(_cast_table(pa.Table.from_batches([batch]), schema))
+            os.unlink(oldfile)
+        if self.arrow_writer is not None:
+            self.arrow_writer.close()
+            oldfile = _partfile(self.arrowfile) + ".old"
+            os.replace(_partfile(self.arrowfile), oldfile)
+            with pa.memory_map(oldfile) as source:
+                table = pa.ipc.open_file(source).read_all()
+            self.arrow_writer = pa.ipc.new_file(_partfile(self.arrowfile), schema)
+            self.arrow_writer.write_table(_cast_table(table, schema))
+            os.unlink(oldfile)
+
+
+def _iter_batches(cursor, fetchsize):
+    """
+    Yields the non-empty batches of the result set, of `fetchsize` rows where the driver allows
+
+    Cursors that can return arrow data (DuckDB, ADBC drivers) yield record batches,
+    so the rows are never converted to python objects and the GIL is not held while reading them.
+    Other cursors yield lists of rows obtained by `fetchmany`.
+    """
+    if hasattr(cursor, "to_arrow_reader"):
+        logger.debug("Fetching the result set as arrow record batches by `to_arrow_reader`")
+        reader = cursor.to_arrow_reader(fetchsize)
+    elif hasattr(cursor, "fetch_record_batch"):
+        logger.debug("Fetching the result set as arrow record batches by `fetch_record_batch`")
+        try:
+            # duckdb takes the batch size (rows_per_batch), ADBC takes no argument
+            reader = cursor.fetch_record_batch(fetchsize)
+        except TypeError:
+            reader = cursor.fetch_record_batch()
+    else:
+        while True:
+            batch = cursor.fetchmany(fetchsize)
+            if len(batch) == 0:
+                return
+            yield batch
+    # arrow readers may yield empty batches in the middle of the stream,
+    # while the caller takes an empty batch as the end
+    for batch in reader:
+        if batch.num_rows > 0:
+            yield batch
+
+
+def _read_arrow(arrowfile, dtype_backend=None):
+    """
+    Returns the content of the arrow IPC file as a data frame
+
+    The file is memory-mapped, so the columns are not copied unless they are converted to numpy types.
+    """
+    with pa.memory_map(arrowfile) as source:
+        table = pa.ipc.open_file(source).read_all()
+    types_mapper = pd.ArrowDtype if dtype_backend == "pyarrow" else None
+    return table.to_pandas(split_blocks=True, self_destruct=True, types_mapper=types_mapper)
+
+
+def _read_parquet_head(parquetfile, nrows, dtype_backend=None):
+    """
+    Returns the first `nrows` rows of the parquet file as a data frame
+
+    The data frame is built from the arrow table, whose column types are already known,
+    so pandas does not infer them. With dtype_backend "pyarrow", the columns are not converted at all.
+    """
+    f = pq.ParquetFile(parquetfile)
+    batches = []
+    for batch in f.iter_batches():
+        if nrows <= 0:
+            break
+        batches.append(batch.slice(0, nrows))
+        nrows -= batch.num_rows
+    table = pa.Table.from_batches(batches, schema=f.schema_arrow)
+    types_mapper = pd.ArrowDtype if dtype_backend == "pyarrow" else None
+    return table.to_pandas(split_blocks=True, self_destruct=True, types_mapper=types_mapper)
+
+
+def _write_batches(batches, names, writer, errors):
+    """
+    Write batches of rows taken from the queue by `writer` until None is received
+
+    Exception raised while writing is appended to `errors` and the remaining batches are discarded.
+    """
+    batch = batches.get()
+    try:
+        while batch is not None:
+            writer.write(_to_arrow_table(batch, names))
+            batch = batches.get()
+    except Exception as e:
+        errors.append(e)
+        while batch is not None:
+            batch = batches.get()
+    finally:
+        try:
+            writer.close()
+        except Exception as e:
+            errors.append(e)
+
+
+def _fetch_and_write(cursor, csvfile=None, parquetfile=None, arrowfile=None, max_df_rows=10000, fetchsize=10000):
     """
-    Write rows to csvfile and pickefile at the same time
+    Write rows to csvfile, parquetfile and arrowfile at the same time
     """
     logger.debug("Start fetching the result set")
-    # delete existing csv file if any
-    if csvfile is not None and os.path.isfile(csvfile):
-        os.unlink(csvfile)
-    if picklefile is not None and os.path.isfile(picklefile):
-        os.unlink(picklefile)
+    # delete existing files if any, so that no stale result is left when nothing is written
+    for file in (csvfile, parquetfile, arrowfile):
+        if file is not None:
+            try:
+                os.unlink(file)
+            except FileNotFoundError:
+                pass
 
     # find column names if any
     header = _get_header(cursor)
+
+    # first, we will check if this result has any data in it
+    fetched = _iter_batches(cursor, fetchsize)
+    try:
+        batch = next(fetched, [])
+    except Exception as e:
+        logger.debug("Fetching the first batch obtained error: '%s'", e)
+        batch = []
+    if header is None and len(batch) > 0:
+        # server-side cursors may describe the columns only after the first fetch
+        header = _get_header(cursor)
     if header is None:
         logger.info("No column names found")
     else:
         logger.debug("Column names: %s", header)
+    if len(batch) == 0:
+        logger.info("No result set in the query outcome")
+        if header is None:
+            logger.debug("Nothing to write because there is no row or header")
+            logger.debug("Finish fetching the result set")
+            return
+    if header is not None:
+        names = header
+    elif isinstance(batch, pa.RecordBatch):
+        names = batch.schema.names
+    else:
+        names = [str(j) for j in range(len(batch[0]))]
 
-    # open csv file
-    if csvfile is not None and header is not None:
-        logger.debug("Writing header to CSV file '%s'", csvfile)
-        with open(csvfile, "wt", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(header)
-    
-    # first, we will check if this result has any data in it
+    # rows are written in a separate thread so that the next batch is fetched in the meantime
+    batches = queue.Queue(maxsize=4)
+    errors = []
+    result_writer = _ResultWriter(names, header is not None, csvfile, parquetfile, arrowfile, max_df_rows, fetchsize)
+    writer = threading.Thread(target=_write_batches, args=(batches, names, result_writer, errors),
+                              name=threading.current_thread().name + "_writer")
+    writer.start()
+    completed = False
     try:
-        row = cursor.fetchone()
-        if row is not None:
-            do_iterate = True
-            rows = [row]
-            if csvfile is not None:
-                logger.debug("Writing first row to CSV file '%s'", csvfile)
-                with open(csvfile, "at", newline="") as f:
-                    writer = csv.writer(f)
-                    writer.writerow(row)
+        batches.put(batch)
+        nrows = len(batch)
+        while len(batch) > 0 and len(errors) == 0:
+            batch = next(fetched, [])
+            if len(batch) > 0:
+                batches.put(batch)
+                nrows += len(batch)
+        completed = True
+    finally:
+        batches.put(None)
+        writer.join()
+        if completed and len(errors) == 0:
+            result_writer.commit()
         else:
-            logger.debug("fetchone obtained None, no result set in the outcome")
-            do_iterate = False
-            rows = []
-    except Exception as e:
-        if type(e) == StopIteration:
-            logger.debug("fetchone method obtained stop iteration error")
-        else:
-            logger.debug("fetchone method obtained error: '%s'", e)
-        logger.info("No result set in the query outcome")
-        rows = []
-        do_iterate = False
-
-    # get remaining rows
-    if do_iterate:
-        if csvfile is not None:
-            logger.debug("Start writing remaining rows to CSV file '%s'", csvfile)
-            f = open(csvfile, "at", newline="")
-            writer = csv.writer(f)
-        else:
-            f = None
-            writer = None
-
-        for i, row in enumerate(cursor):
-            # note: we already have one record
-            if i+1 < max_df_rows:
-                rows.append(row)
-            elif i+1 == max_df_rows:
-                logger.info("Data frame is truncated to %d rows", max_df_rows)
-            if writer is not None:
-                writer.writerow(row)
-        if f is not None:
-            logger.info("Finish writing to CSV file '%s'", csvfile)
-            f.close()
-
-    # write pickle only if there are some rows or header
-    if (picklefile is not None) and (len(rows) > 0 or header is not None):
-        df = pd.DataFrame(rows, columns=header)
-        df.to_pickle(picklefile)
-        logger.info("Data frame is written to '%s'", picklefile)
-    else:
-        logger.debug("Nothing to write to pickle because there is no row or header")
+            result_writer.discard()
+    if len(errors) > 0:
+        raise errors[0]
 
+    logger.info("%d rows have been fetched", nrows)
     logger.debug("Finish fetching the result set")
-    
\ No newline at end of file
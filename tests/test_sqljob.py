@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+import sqlite3
+import warnings
+import concurrent.futures
+from unittest import mock
+from decimal import Decimal
+
+import pandas as pd
+import pyarrow as pa
+import sqlalchemy
+
+from sqljob import SqlJob, Connector
+from sqljob.sqljob import _fetch_and_write
+
+
+class FakeCursor:
+    """
+    Minimal DB-API cursor returning the given rows
+    """
+    def __init__(self, names, rows, scales=None):
+        scales = scales or [None] * len(names)
+        self.description = [(name, None, None, None, None, scale, None) for name, scale in zip(names, scales)]
+        self.rows = list(rows)
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+
+class FailingCursor(FakeCursor):
+    """
+    Cursor that fails after returning the first batch
+    """
+    def fetchmany(self, size):
+        if len(self.rows) == 0:
+            raise RuntimeError("connection lost")
+        return super().fetchmany(size)
+
+
+class FakeArrowCursor:
+    """
+    Minimal ADBC-like cursor returning the given record batches
+    """
+    def __init__(self, batches):
+        self.description = [(name, None, None, None, None, None, None) for name in batches[0].schema.names]
+        self.batches = batches
+
+    def fetch_record_batch(self):
+        return pa.RecordBatchReader.from_batches(self.batches[0].schema, self.batches)
+
+
+class TestFetchAndWrite(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csvfile = os.path.join(self.tmpdir, "result.csv")
+        self.parquetfile = os.path.join(self.tmpdir, "result.parquet")
+        self.arrowfile = os.path.join(self.tmpdir, "result.arrow")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, cursor, fetchsize=2):
+        _fetch_and_write(cursor, self.csvfile, self.parquetfile, self.arrowfile, fetchsize=fetchsize)
+        return pd.read_parquet(self.parquetfile)
+
+    def test_float_after_int_batch_is_not_truncated(self):
+        df = self._run(FakeCursor(["x"], [(1,), (2,), (2.5,)]))
+        self.assertEqual(df["x"].tolist(), [1.0, 2.0, 2.5])
+        self.assertEqual(pd.read_csv(self.csvfile)["x"].tolist(), [1.0, 2.0, 2.5])
+        self.assertEqual(pd.read_feather(self.arrowfile)["x"].tolist(), [1.0, 2.0, 2.5])
+
+    def test_text_after_int_batch(self):
+        df = self._run(FakeCursor(["x"], [(1,), (2,), ("a",)]))
+        self.assertEqual(df["x"].tolist(), ["1", "2", "a"])
+
+    def test_large_int_after_first_batch(self):
+        df = self._run(FakeCursor(["x"], [(1,), (2,), (2**70,)]))
+        self.assertEqual(df["x"].tolist(), ["1", "2", str(2**70)])
+
+    def test_decimal_grows_across_batches(self):
+        values = [Decimal("1.50"), Decimal("2.25"), Decimal("123.45"), Decimal("1234567.8")]
+        df = self._run(FakeCursor(["x"], [(v,) for v in values]))
+        self.assertEqual(df["x"].tolist(), values)
+
+    def test_decimal_scale_grows_across_batches(self):
+        values = [Decimal("1.5"), Decimal("2"), Decimal("3.123")]
+        df = self._run(FakeCursor(["x"], [(v,) for v in values]))
+        self.assertEqual(df["x"].tolist(), values)
+
+    def test_large_decimal_without_scale(self):
+        values = [Decimal(10**20), Decimal(10**25), Decimal(1)]
+        df = self._run(FakeCursor(["x"], [(v,) for v in values]))
+        self.assertEqual(df["x"].tolist(), values)
+
+    def test_csv_keeps_decimal_scale(self):
+        self._run(FakeCursor(["x"], [(Decimal("1.50"),), (Decimal("2.25"),)]))
+        with open(self.csvfile) as f:
+            self.assertEqual(f.read().split(), ['"x"', "1.50", "2.25"])
+
+    def test_large_int_is_stored_as_string(self):
+        df = self._run(FakeCursor(["x"], [(2**70,), (1,), (2,)]))
+        self.assertEqual(df["x"].tolist(), [str(2**70), "1", "2"])
+
+    def test_null_first_batch(self):
+        df = self._run(FakeCursor(["x"], [(None,), (None,), (3,), (4,)]))
+        self.assertEqual(df["x"].tolist()[2:], [3, 4])
+
+    def test_uuid_list_and_dict_columns(self):
+        u = uuid.uuid4()
+        self._run(FakeCursor(["u", "l", "d"], [(u, [1, 2], {"a": 1}), (u, [3], {"a": 2})]))
+        df = pd.read_csv(self.csvfile)
+        self.assertEqual(df["u"].tolist(), [str(u)] * 2)
+        self.assertEqual(len(df), 2)
+
+    def test_empty_record_batch_in_stream(self):
+        schema = pa.schema([("x", pa.int64())])
+        batches = [pa.record_batch([pa.array([1])], schema=schema),
+                   pa.record_batch([pa.array([], type=pa.int64())], schema=schema),
+                   pa.record_batch([pa.array([2, 3, 4])], schema=schema)]
+        df = self._run(FakeArrowCursor(batches))
+        self.assertEqual(df["x"].tolist(), [1, 2, 3, 4])
+        self.assertEqual(pd.read_csv(self.csvfile)["x"].tolist(), [1, 2, 3, 4])
+
+    def test_csv_matches_rows(self):
+        self._run(FakeCursor(["x", "y"], [(1, "a"), (2, None), (3, "c")]))
+        df = pd.read_csv(self.csvfile)
+        self.assertEqual(df["x"].tolist(), [1, 2, 3])
+
+    def test_no_partial_files_on_failure(self):
+        with self.assertRaises(RuntimeError):
+            self._run(FailingCursor(["x"], [(1,), (2,)]))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_existing_files_are_replaced(self):
+        self._run(FakeCursor(["x"], [(1,), (2,), (3,)]))
+        df = self._run(FakeCursor(["x"], [(4,)]))
+        self.assertEqual(df["x"].tolist(), [4])
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["result.arrow", "result.csv", "result.parquet"])
+
+
+class TestSqlalchemyUrl(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        self.result_dir = SqlJob.result_dir
+        SqlJob.result_dir = os.path.join(self.tmpdir, "results")
+
+    def tearDown(self):
+        SqlJob.result_dir = self.result_dir
+        shutil.rmtree(self.tmpdir)
+
+    def test_driver_paramstyle(self):
+        SqlJob("CREATE TABLE test (x int, y text)", self.url).start().wait()
+        SqlJob("INSERT INTO test VALUES (?, ?)", self.url, params=[(1, ":a"), (2, "b")], manyparams=True).start().wait()
+        job = SqlJob("SELECT y FROM test WHERE x = ?", self.url, params=(1,)).start().wait()
+        self.assertEqual(job.result_df["y"].tolist(), [":a"])
+        job = SqlJob("SELECT ':word' AS z", self.url).start().wait()
+        self.assertEqual(job.result_df["z"].tolist(), [":word"])
+
+    def test_statement_without_rows(self):
+        for query in ("CREATE TABLE test (x int)", "UPDATE test SET x = 1"):
+            job = SqlJob(query, self.url).start().wait()
+            self.assertFalse(job.failed())
+            for file in (job.csvfile, job.parquetfile, job.arrowfile):
+                self.assertFalse(os.path.exists(file))
+            self.assertIsNone(job.result_df)
+
+    def test_server_side_cursor(self):
+        SqlJob("CREATE TABLE test (x int, y text)", self.url).start().wait()
+        # the commit runs after the fetch with server-side cursors
+        job = SqlJob("INSERT INTO test VALUES (?, ?)", self.url, params=[(i, str(i)) for i in range(5)],
+                     manyparams=True, server_side_cursor=True).start().wait()
+        self.assertFalse(job.failed())
+        job = SqlJob("SELECT * FROM test", self.url, server_side_cursor=True, fetchsize=2).start().wait()
+        self.assertEqual(job.result_df["x"].tolist(), list(range(5)))
+        df = pd.read_csv(job.csvfile)
+        self.assertEqual(list(df.columns), ["x", "y"])
+        self.assertEqual(df["y"].tolist(), list(range(5)))
+
+    def test_failed_job_has_no_result(self):
+        # keep the expected traceback of the job thread out of the test output
+        with mock.patch("threading.excepthook"):
+            job = SqlJob("SELECT * FROM missing_table", self.url).start().wait()
+        self.assertTrue(job.failed())
+        self.assertIsNone(job.result_df)
+
+
+class SqliteTestCase(unittest.TestCase):
+    """
+    Runs jobs against a sqlite database with table `test` holding `rows`
+    """
+    rows = [(1, "a"), (2, "b")]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tmpdir, "test.db")
+        with sqlite3.connect(self.dbfile) as conn:
+            conn.execute("CREATE TABLE test (x int, y text)")
+            conn.executemany("INSERT INTO test VALUES (?, ?)", self.rows)
+        self.result_dir = SqlJob.result_dir
+        SqlJob.result_dir = os.path.join(self.tmpdir, "results")
+
+    def tearDown(self):
+        SqlJob.result_dir = self.result_dir
+        shutil.rmtree(self.tmpdir)
+
+
+class TestResultDf(SqliteTestCase):
+    rows = [(i, chr(ord("a") + i)) for i in range(10)]
+
+    def _run(self, **kwargs):
+        return SqlJob("SELECT * FROM test", Connector(sqlite3, self.dbfile), **kwargs).start().wait()
+
+    def test_read_arrow_file(self):
+        job = self._run(fetchsize=3)
+        self.assertEqual(pd.read_feather(job.arrowfile)["x"].tolist(), list(range(10)))
+        df = job.result_df
+        self.assertEqual(df["x"].tolist(), list(range(10)))
+        self.assertEqual(df["y"].tolist(), list("abcdefghij"))
+
+    def test_max_df_rows_smaller_than_fetchsize(self):
+        job = self._run(max_df_rows=4, fetchsize=6)
+        self.assertEqual(job.result_df["x"].tolist(), list(range(4)))
+        self.assertEqual(len(pd.read_parquet(job.parquetfile)), 10)
+
+    def test_max_df_rows_larger_than_fetchsize(self):
+        job = self._run(max_df_rows=7, fetchsize=3)
+        self.assertEqual(job.result_df["x"].tolist(), list(range(7)))
+        self.assertEqual(len(pd.read_parquet(job.parquetfile)), 10)
+
+    def test_parquet_fallback(self):
+        job = self._run(max_df_rows=4, fetchsize=3)
+        os.unlink(job.arrowfile)
+        df = job.result_df
+        self.assertEqual(df["x"].tolist(), list(range(4)))
+        self.assertEqual(df["y"].tolist(), list("abcd"))
+
+    def test_legacy_pickle(self):
+        job = self._run()
+        os.unlink(job.arrowfile)
+        os.unlink(job.parquetfile)
+        pd.DataFrame({"z": [1, 2]}).to_pickle(job._legacy_picklefile)
+        self.assertEqual(job.result_df["z"].tolist(), [1, 2])
+
+    def test_pyarrow_dtype_backend(self):
+        job = self._run(dtype_backend="pyarrow")
+        df = job.result_df
+        self.assertTrue(all(isinstance(t, pd.ArrowDtype) for t in df.dtypes))
+        self.assertEqual(df["x"].tolist(), list(range(10)))
+
+    def test_pyarrow_dtype_backend_parquet_fallback(self):
+        job = self._run(dtype_backend="pyarrow", max_df_rows=4)
+        os.unlink(job.arrowfile)
+        df = job.result_df
+        self.assertTrue(all(isinstance(t, pd.ArrowDtype) for t in df.dtypes))
+        self.assertEqual(df["y"].tolist(), list("abcd"))
+
+    def test_result_df_is_cached(self):
+        job = self._run()
+        job.result_df["w"] = 1
+        os.unlink(job.arrowfile)
+        self.assertEqual(list(job.result_df.columns), ["x", "y"])
+
+    def test_modifying_result_df_keeps_cache(self):
+        job = self._run()
+        df = job.result_df
+        df.loc[0, "x"] = 100
+        self.assertEqual(job.result_df["x"].tolist(), list(range(10)))
+
+
+class TestCompressedCsv(SqliteTestCase):
+    rows = [(1, "a"), (2, None), (3, "c,d")]
+
+    def _roundtrip(self, csvfile):
+        job = SqlJob("SELECT * FROM test", Connector(sqlite3, self.dbfile), csvfile=csvfile, fetchsize=2).start().wait()
+        df = pd.read_csv(job.csvfile)
+        self.assertEqual(df["x"].tolist(), [1, 2, 3])
+        self.assertEqual(df["y"].fillna("").tolist(), ["a", "", "c,d"])
+
+    def test_gzip(self):
+        self._roundtrip("x.csv.gz")
+
+    def test_bz2(self):
+        self._roundtrip("x.csv.bz2")
+
+
+class TestMultiprocessingBackend(SqliteTestCase):
+    def _run(self, connector):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            job = SqlJob("SELECT * FROM test", connector, backend="multiprocessing").start().wait()
+        self.assertFalse(job.running())
+        return job
+
+    def test_picklable_connector_runs_on_pool(self):
+        job = self._run(Connector(sqlite3, self.dbfile))
+        self.assertIsInstance(job.worker, concurrent.futures.Future)
+        self.assertEqual(job.result_df["x"].tolist(), [1, 2])
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires fork")
+    def test_engine_connector_runs_on_own_process(self):
+        job = self._run(sqlalchemy.create_engine("sqlite:///" + self.dbfile))
+        self.assertNotIsInstance(job.worker, concurrent.futures.Future)
+        self.assertEqual(job.result_df["y"].tolist(), ["a", "b"])
+
+
+if __name__ == "__main__":
+    unittest.main()